@@ -2,16 +2,20 @@
 
 import argparse
 import socketio
-import json
+import orjson
 import time
 import sqlite3
 from escpos.printer import Usb
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
+import queue
+import heapq
 import logging
 import os
-from typing import Dict, Any
-from print_receipt import print_receipt
+from concurrent.futures import Future
+from typing import Dict, Any, List, Tuple
+from print_receipt import CUT, LOGO_PATH, build_receipt_bytes, render_logo
+import fast_json
 
 
 logging.root.setLevel(logging.INFO)
@@ -28,13 +32,35 @@ else:
 logger = logging.getLogger(__name__)
 
 DB_NAME = 'printer_queue.db'
-
-
-def initialize_db():
+BUSY_TIMEOUT_MS = 30000
+COMPLETED_JOBS_RETENTION_DAYS = 7
+PURGE_INTERVAL = 24 * 60 * 60  # Seconds between purges of old completed jobs
+INSERT_BATCH_WINDOW = 0.02  # Seconds to wait for more receipts to insert together
+INSERT_BATCH_MAX = 64
+READY_RING_CAPACITY = 256  # Must be a power of two
+DB_ERROR_RETRY_DELAY = 5  # Seconds before retrying a job whose database update failed
+PRINT_BATCH_MAX = 4  # Receipts sent to the printer in a single USB write
+PRINT_BATCH_MAX_BYTES = 32 * 1024  # Room for a few receipts with their logo
+
+
+def connect_db() -> sqlite3.Connection:
+    """Open a long-lived autocommit connection shareable across threads."""
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row  # To access columns by name
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS};")
+    return conn
+
+
+def initialize_db(conn: sqlite3.Connection):
     """Initialize the SQLite database and create table if not exists."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
+    if DB_NAME != ':memory:':
+        # WAL lets the queue thread read while the WebSocket thread inserts
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA wal_autocheckpoint=1000;")
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS print_jobs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             receipt_data TEXT NOT NULL,
@@ -42,81 +68,331 @@ def initialize_db():
             created_at TEXT NOT NULL,
             last_attempt TEXT,
             status TEXT NOT NULL DEFAULT 'pending',
-            last_error TEXT
+            last_error TEXT,
+            visible_at REAL NOT NULL DEFAULT 0
         )
     """)
-    conn.commit()
-    conn.close()
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(print_jobs)")]
+    if 'visible_at' not in columns:
+        # Databases created before retries were scheduled
+        conn.execute(
+            "ALTER TABLE print_jobs ADD COLUMN visible_at REAL NOT NULL DEFAULT 0")
+    # Partial index so get_next_job seeks instead of scanning completed jobs
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_pending
+        ON print_jobs(created_at)
+        WHERE status = 'pending'
+    """)
     logger.info("Database initialized/checked.")
 
 
+# Statements run by PrinterQueue. sqlite3 caches prepared statements per
+# connection, keyed by SQL text; with one long-lived connection and a single
+# definition of each statement, each is compiled once instead of on every call.
+SQL_INSERT_JOB = """
+    INSERT INTO print_jobs (receipt_data, created_at)
+    VALUES (?, ?)
+"""
+SQL_LAST_INSERT_ID = "SELECT last_insert_rowid()"
+SQL_MAX_JOB_ID = "SELECT COALESCE(MAX(id), 0) FROM print_jobs"
+SQL_RECLAIM_IN_PROGRESS = """
+    UPDATE print_jobs
+    SET status = 'pending'
+    WHERE status = 'in_progress' AND id <= ?
+"""
+SQL_LOAD_PENDING = """
+    SELECT id, receipt_data, attempts, visible_at
+    FROM print_jobs
+    WHERE status = 'pending' AND id <= ?
+    ORDER BY created_at
+"""
+SQL_CLAIM_JOB = """
+    UPDATE print_jobs
+    SET status = 'in_progress',
+        last_attempt = ?
+    WHERE id = ?
+"""
+SQL_MARK_COMPLETE = """
+    UPDATE print_jobs
+    SET status = 'completed'
+    WHERE id = ?
+"""
+SQL_MARK_FAILED = """
+    UPDATE print_jobs
+    SET status = ?,
+        attempts = attempts + 1,
+        last_attempt = ?,
+        last_error = ?,
+        visible_at = ?
+    WHERE id = ?
+"""
+SQL_PURGE_COMPLETED = """
+    DELETE FROM print_jobs
+    WHERE status = 'completed' AND created_at < ?
+"""
+
+
+class SPSCRing:
+    """
+    Bounded single-producer / single-consumer ring buffer.
+
+    Only one thread may call push and only one thread may call pop. head is
+    only written by the producer and tail only by the consumer, and the GIL
+    orders the slot store before the index update, so no lock is needed.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("Ring capacity must be a power of two.")
+        self.slots: List[Any] = [None] * capacity
+        self.mask = capacity - 1
+        self.head = 0  # Next slot to write
+        self.tail = 0  # Next slot to read
+
+    def __len__(self) -> int:
+        return self.head - self.tail
+
+    def push(self, item: Any) -> bool:
+        """Store an item, return False if the ring is full."""
+        if self.head - self.tail > self.mask:
+            return False
+        self.slots[self.head & self.mask] = item
+        self.head += 1
+        return True
+
+    def pop(self) -> Any | None:
+        """Take the oldest item, or None if the ring is empty."""
+        if self.tail == self.head:
+            return None
+        index = self.tail & self.mask
+        item = self.slots[index]
+        self.slots[index] = None
+        self.tail += 1
+        return item
+
+
 class PrinterQueue:
     def __init__(self):
-        initialize_db()
+        # One connection shared by the WebSocket and queue threads, so the
+        # page and statement caches stay warm between operations
+        self._conn = connect_db()
+        self._lock = threading.Lock()
+        self._cv = threading.Condition()
+        self._has_new_jobs = False
+        initialize_db(self._conn)
+        # Jobs already in the database when the queue was created are only
+        # known to SQLite and are loaded by load_pending_jobs; everything
+        # added afterwards is handed to the processor in memory
+        with self._lock:
+            self._recovery_max_id = self._conn.execute(
+                SQL_MAX_JOB_ID).fetchone()[0]
+        # Receipts waiting to be inserted by the writer thread
+        self._pending: queue.Queue = queue.Queue()
+        # Persisted jobs ready to print, as (job_id, receipt_data, attempts);
+        # the writer thread is the only producer, the processor the only consumer
+        self._ready = SPSCRing(READY_RING_CAPACITY)
+        # Owned by the queue processor thread: jobs waiting for a retry, as
+        # (visible_at, job_id, receipt_data, attempts), and the jobs handed
+        # out by get_next_job that are not completed or failed yet
+        self._scheduled: List[Tuple[float, int, dict, int]] = []
+        self._in_flight: Dict[int, Tuple[dict, int]] = {}
+        writer_thread = threading.Thread(
+            target=self._write_pending_jobs, daemon=True)
+        writer_thread.start()
+
+    def notify(self):
+        """Wake up the queue processor waiting in wait_for_job."""
+        with self._cv:
+            self._has_new_jobs = True
+            self._cv.notify()
+
+    def wait_for_job(self, timeout: float):
+        """Block until a job is added (or notify is called) or timeout elapses."""
+        with self._cv:
+            self._cv.wait_for(lambda: self._has_new_jobs, timeout)
+            self._has_new_jobs = False
+
+    def add_to_queue(self, receipt_data: Dict[str, Any]) -> Future:
+        """Add a receipt to the queue, the returned future resolves to its job id."""
+        future = Future()
+        # Stored as the raw orjson bytes (a BLOB value); rows written as TEXT
+        # by older versions still load, orjson.loads accepts both
+        self._pending.put((receipt_data, orjson.dumps(receipt_data),
+                           datetime.now().isoformat(), future))
+        return future
+
+    def _write_pending_jobs(self):
+        """Writer thread: insert receipts arriving close together in one transaction."""
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + INSERT_BATCH_WINDOW
+            while len(batch) < INSERT_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
 
-    def add_to_queue(self, receipt_data: Dict[str, Any]) -> int:
-        """Add a receipt to the queue."""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        now = datetime.now().isoformat()
-        cursor.execute("""
-            INSERT INTO print_jobs (receipt_data, created_at)
-            VALUES (?, ?)
-        """, (json.dumps(receipt_data), now))
-        job_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        logger.info(f"Added job {job_id} to queue")
-        return job_id
-
-    def get_next_job(self) -> tuple[int, dict] | None:
-        """Get the next pending job from the queue."""
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row  # To access columns by name
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, receipt_data, attempts
-            FROM print_jobs
-            WHERE status = 'pending'
-            ORDER BY created_at
-            LIMIT 1
-        """)
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            return row['id'], json.loads(row['receipt_data']), row['attempts']
-        return None
+            try:
+                job_ids = self._insert_jobs(
+                    [(receipt_json, created_at) for _, receipt_json, created_at, _ in batch])
+            except Exception as e:
+                logger.error(f"Error adding {len(batch)} jobs to queue: {e}")
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (receipt_data, _, _, future), job_id in zip(batch, job_ids):
+                logger.info(f"Added job {job_id} to queue")
+                while not self._ready.push((job_id, receipt_data, 0)):
+                    # The processor is far behind; make sure it is awake and
+                    # wait for it to free a slot
+                    self.notify()
+                    time.sleep(0.01)
+                future.set_result(job_id)
+            self.notify()
+
+    def _insert_jobs(self, rows: List[Tuple[bytes, str]]) -> List[int]:
+        """Insert (receipt_data, created_at) rows in a single transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(SQL_INSERT_JOB, rows)
+                # executemany does not set lastrowid, but rows inserted by a
+                # single transaction under the lock get consecutive ids
+                last_id = self._conn.execute(SQL_LAST_INSERT_ID).fetchone()[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def load_pending_jobs(self) -> int:
+        """Schedule the jobs left pending in the database by a previous run."""
+        with self._lock:
+            # Jobs that were being printed when the previous run stopped
+            self._conn.execute(SQL_RECLAIM_IN_PROGRESS, (self._recovery_max_id,))
+            rows = self._conn.execute(
+                SQL_LOAD_PENDING, (self._recovery_max_id,)).fetchall()
+        for row in rows:
+            heapq.heappush(self._scheduled, (row['visible_at'], row['id'],
+                                             orjson.loads(row['receipt_data']), row['attempts']))
+        return len(rows)
+
+    def get_next_job(self, scheduled_only: bool = False) -> tuple[int, dict] | None:
+        """
+        Get the next pending job from the queue whose retry delay has elapsed.
+
+        With scheduled_only, only jobs loaded by load_pending_jobs or waiting
+        for a retry are returned, not the ones added since the queue started.
+        """
+        if self._scheduled and self._scheduled[0][0] <= time.time():
+            _, job_id, receipt_data, attempts = heapq.heappop(self._scheduled)
+        elif scheduled_only:
+            return None
+        else:
+            job_info = self._ready.pop()
+            if job_info is None:
+                return None
+            job_id, receipt_data, attempts = job_info
+        self._in_flight[job_id] = (receipt_data, attempts)
+        return job_id, receipt_data, attempts
+
+    def requeue_jobs(self, job_ids: List[int], delay: float):
+        """
+        Put jobs handed out by get_next_job back in the queue, without touching
+        the database, so they are dispatched again after delay seconds.
+        """
+        visible_at = time.time() + delay
+        for job_id in job_ids:
+            in_flight = self._in_flight.pop(job_id, None)
+            if in_flight:
+                receipt_data, attempts = in_flight
+                heapq.heappush(self._scheduled,
+                               (visible_at, job_id, receipt_data, attempts))
+
+    def forget_jobs(self, job_ids: List[int]):
+        """Stop tracking jobs handed out by get_next_job, leaving their rows as they are."""
+        for job_id in job_ids:
+            self._in_flight.pop(job_id, None)
+
+    def seconds_until_next_job(self) -> float | None:
+        """Seconds until a pending job becomes visible, None if there are none."""
+        if self._ready:
+            return 0.0
+        if not self._scheduled:
+            return None
+        return max(0.0, self._scheduled[0][0] - time.time())
 
     def mark_job_complete(self, job_id: int):
         """Mark a job as completed."""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE print_jobs
-            SET status = 'completed'
-            WHERE id = ?
-        """, (job_id,))
-        conn.commit()
-        conn.close()
-        logger.info(f"Job {job_id} completed successfully")
-
-    def mark_job_failed(self, job_id: int, error: str):
-        """Mark a job as failed and update retry information."""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE print_jobs
-            SET status = 'pending',
-                attempts = attempts + 1,
-                last_attempt = ?,
-                last_error = ?
-            WHERE id = ?
-        """, (datetime.now().isoformat(), str(error), job_id))
-        conn.commit()
-        conn.close()
+        self.mark_jobs_complete([job_id])
+
+    def _executemany_in_transaction(self, sql: str, rows: List[tuple]):
+        """Run sql once per row, committing all of them together."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def claim_jobs(self, job_ids: List[int]):
+        """
+        Mark jobs about to be printed as 'in_progress', in a single transaction.
+
+        They stay that way until completed or failed, so jobs interrupted
+        mid-print are visible as such and are reclaimed on the next start.
+        """
+        now = datetime.now().isoformat()
+        self._executemany_in_transaction(
+            SQL_CLAIM_JOB, [(now, job_id) for job_id in job_ids])
+
+    def mark_jobs_complete(self, job_ids: List[int]):
+        """Mark several jobs as completed in a single transaction."""
+        self._executemany_in_transaction(
+            SQL_MARK_COMPLETE, [(job_id,) for job_id in job_ids])
+        for job_id in job_ids:
+            self._in_flight.pop(job_id, None)
+            logger.info(f"Job {job_id} completed successfully")
+
+    def mark_job_failed(self, job_id: int, error: str, retry_delay: float | None = None):
+        """
+        Mark a job as failed and update retry information.
+
+        Args:
+            job_id (int): ID of the failed job.
+            error (str): Error to record for the attempt.
+            retry_delay (float | None): Seconds before the job is picked up again.
+                If None, the job is given up on and will not be retried.
+        """
+        status = 'failed' if retry_delay is None else 'pending'
+        visible_at = time.time() + (retry_delay or 0)
+        with self._lock:
+            self._conn.execute(
+                SQL_MARK_FAILED,
+                (status, datetime.now().isoformat(), str(error), visible_at, job_id))
+        in_flight = self._in_flight.pop(job_id, None)
+        if in_flight and retry_delay is not None:
+            receipt_data, attempts = in_flight
+            heapq.heappush(self._scheduled,
+                           (visible_at, job_id, receipt_data, attempts + 1))
         logger.warning(
             f"Job {job_id} marked as failed, attempt incremented. Error: {error}")
 
+    def purge_completed_jobs(self, max_age_days: int = COMPLETED_JOBS_RETENTION_DAYS) -> int:
+        """Delete completed jobs older than max_age_days, return how many."""
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+        with self._lock:
+            cursor = self._conn.execute(SQL_PURGE_COMPLETED, (cutoff,))
+        if cursor.rowcount:
+            logger.info(f"Purged {cursor.rowcount} completed jobs")
+        return cursor.rowcount
+
 
 class PrinterManager:
     def __init__(self, vendor_id: int = int("0x1fc9", 16), product_id: int = int("0x2016", 16)):
@@ -131,8 +407,26 @@ class PrinterManager:
         self.product_id = product_id
         self.printer = None
         self.queue = PrinterQueue()
-        self.max_retries = 3
+        # Retries no longer block the worker, so the budget can cover a printer
+        # that is unplugged or out of paper for a while: with the delay capped
+        # at a minute, 20 attempts keep a job alive for about 13 minutes
+        self.max_retries = 20
         self.initial_retry_delay = 0.5
+        self.max_retry_delay = 60
+        self.idle_timeout = 5
+        # Rasterized once, every receipt reuses the same bytes
+        self.logo_bytes = self.load_logo(LOGO_PATH)
+        # Job taken from the queue that did not fit in the previous batch
+        self._carried_job = None
+
+    def load_logo(self, path: str) -> bytes:
+        """Render the receipt logo to ESC/POS bytes, or no logo if that fails."""
+        try:
+            return render_logo(path)
+        except Exception as e:
+            logger.error(
+                f"Error loading logo {path}, receipts will be printed without it: {e}")
+            return b''
 
     def connect_printer(self) -> bool:
         """Attempt to connect to the printer."""
@@ -153,66 +447,159 @@ class PrinterManager:
         # Process pending jobs at startup
         self.process_pending_jobs_at_startup()
 
+        last_purge = None
         while True:
             try:
-                job_info = self.queue.get_next_job()
-                if job_info:
-                    job_id, job_data, attempts = job_info
-                    self.print_receipt_with_retry(job_id, job_data, attempts)
-                else:
-                    time.sleep(1)  # Wait before checking for new jobs
+                if last_purge is None or time.monotonic() - last_purge >= PURGE_INTERVAL:
+                    self.queue.purge_completed_jobs()
+                    last_purge = time.monotonic()
+
+                batch = self.next_print_batch()
+                if batch:
+                    self.print_batch_with_retry(batch)
+                    continue
+
+                # Sleep until a new job is added or a failed one is due again;
+                # the idle timeout is a safety net
+                timeout = self.idle_timeout
+                next_job_in = self.queue.seconds_until_next_job()
+                if next_job_in is not None:
+                    timeout = min(timeout, next_job_in)
+                self.queue.wait_for_job(timeout=timeout)
             except Exception as e:
                 logger.error(f"Error in process_queue loop: {e}")
                 time.sleep(1)
 
     def process_pending_jobs_at_startup(self):
         """Process any pending jobs in the database at startup."""
-        while True:
-            job_info = self.queue.get_next_job()
-            if not job_info:
-                break  # No more pending jobs
-            job_id, job_data, attempts = job_info
+        recovered = self.queue.load_pending_jobs()
+        if recovered:
             logger.info(
-                f"Processing pending job {job_id} from database on startup.")
-            success = self.print_receipt_with_retry(job_id, job_data, attempts)
+                f"Loaded {recovered} pending jobs from database on startup.")
+        while True:
+            # Jobs added since startup are left to process_queue
+            batch = self.next_print_batch(scheduled_only=True)
+            if not batch:
+                break  # No more pending jobs from the database
+            job_ids = [job_id for (job_id, _), _ in batch]
+            logger.info(f"Processing pending jobs {job_ids} on startup.")
+            success = self.print_batch_with_retry(batch)
             if not success:
                 logger.error(
-                    f"Failed to process job {job_id} on startup, check logs for details.")
+                    f"Failed to process jobs {job_ids} on startup, check logs for details.")
 
-    def print_receipt_with_retry(self, job_id: int, receipt_data: dict, attempts: int) -> bool:
-        """Attempt to print a receipt with retry logic."""
-        retries_remaining = self.max_retries - attempts
-        if retries_remaining <= 0:
-            logger.error(
-                f"Job {job_id} exceeded maximum retries. Logging failure.")
-            # Mark as failed in db, even though status is already pending
-            self.queue.mark_job_failed(job_id, "Exceeded maximum retries")
-            return False
+    def next_print_batch(self, scheduled_only: bool = False) -> List[Tuple[Tuple[int, int], bytes]]:
+        """
+        Take up to PRINT_BATCH_MAX due jobs from the queue and render them.
+        scheduled_only is passed on to PrinterQueue.get_next_job.
 
-        for attempt in range(retries_remaining):
+        Returns ((job_id, attempts), receipt_bytes) pairs whose receipts add up
+        to at most PRINT_BATCH_MAX_BYTES (a single receipt is always allowed);
+        a job that does not fit is kept for the next batch.
+        """
+        batch = []
+        batch_size = 0
+        while len(batch) < PRINT_BATCH_MAX:
+            if self._carried_job is not None:
+                job, receipt_bytes = self._carried_job
+                self._carried_job = None
+            else:
+                job_info = self.queue.get_next_job(scheduled_only)
+                if not job_info:
+                    break
+                job_id, job_data, attempts = job_info
+                if attempts >= self.max_retries:
+                    logger.error(
+                        f"Job {job_id} exceeded maximum retries. Logging failure.")
+                    self.mark_job_failed(job_id, "Exceeded maximum retries")
+                    continue
+                try:
+                    receipt_bytes = build_receipt_bytes(
+                        job_data, self.logo_bytes) + CUT
+                except Exception as e:
+                    # Malformed receipt data, retrying would not help
+                    logger.error(f"Error rendering receipt for job {job_id}: {e}")
+                    self.mark_job_failed(job_id, str(e))
+                    continue
+                job = (job_id, attempts)
+
+            if batch and batch_size + len(receipt_bytes) > PRINT_BATCH_MAX_BYTES:
+                self._carried_job = (job, receipt_bytes)
+                break
+            batch.append((job, receipt_bytes))
+            batch_size += len(receipt_bytes)
+
+        if batch:
+            job_ids = [job_id for (job_id, _), _ in batch]
             try:
-                if not self.printer:
-                    if not self.connect_printer():
-                        raise Exception("Printer not available")
+                self.queue.claim_jobs(job_ids)
+            except Exception as e:
+                # The jobs only live in memory now, put them back to retry
+                logger.error(
+                    f"Error claiming jobs {job_ids}, retrying in {DB_ERROR_RETRY_DELAY} seconds: {e}")
+                self.queue.requeue_jobs(job_ids, DB_ERROR_RETRY_DELAY)
+                return []
+        return batch
 
-                print_receipt(receipt_data, self.printer)
-                self.queue.mark_job_complete(job_id)
-                return True  # Successfully printed
+    def print_batch_with_retry(self, batch: List[Tuple[Tuple[int, int], bytes]]) -> bool:
+        """
+        Attempt to print a batch of rendered receipts once, in a single write.
 
-            except Exception as e:
-                retry_delay = self.initial_retry_delay * \
-                    (2**attempt)  # Exponential backoff
-                logger.warning(
-                    f"Print attempt {attempts + attempt + 1}/{self.max_retries} for job {job_id} failed: {e}. "
-                    f"Retrying in {retry_delay:.2f} seconds..."
-                )
-                self.printer = None  # Reset printer connection on failure
-                time.sleep(retry_delay)
+        On failure every job in the batch is rescheduled with exponential
+        backoff instead of sleeping here, so other pending jobs are not
+        blocked in the meantime.
+        """
+        try:
+            if not self.printer:
+                if not self.connect_printer():
+                    raise Exception("Printer not available")
+
+            # One USB bulk transfer for all receipts, each ending with its cut
+            self.printer._raw(b''.join(receipt_bytes for _, receipt_bytes in batch))
+
+        except Exception as e:
+            self.printer = None  # Reset printer connection on failure
+            for (job_id, attempts), _ in batch:
+                self.schedule_retry(job_id, attempts, e)
+            return False
+
+        # The receipts are on paper, so a database error here must not lead
+        # to a retry; the rows stay 'in_progress' and are reclaimed at startup
+        job_ids = [job_id for (job_id, _), _ in batch]
+        try:
+            self.queue.mark_jobs_complete(job_ids)
+        except Exception as e:
+            logger.error(f"Jobs {job_ids} printed but could not be marked complete: {e}")
+            self.queue.forget_jobs(job_ids)
+        return True  # Successfully printed
+
+    def schedule_retry(self, job_id: int, attempts: int, error: Exception):
+        """Reschedule a failed job with exponential backoff, or give up on it."""
+        if attempts + 1 >= self.max_retries:
+            logger.error(
+                f"Job {job_id} failed after {self.max_retries} attempts.")
+            self.mark_job_failed(job_id, str(error))
+            return
+
+        retry_delay = min(self.initial_retry_delay * (2**attempts),
+                          self.max_retry_delay)  # Capped exponential backoff
+        logger.warning(
+            f"Print attempt {attempts + 1}/{self.max_retries} for job {job_id} failed: {error}. "
+            f"Retrying in {retry_delay:.2f} seconds..."
+        )
+        self.mark_job_failed(job_id, str(error), retry_delay)
 
-        # If all retries failed
-        logger.error(f"Job {job_id} failed after {self.max_retries} attempts.")
-        self.queue.mark_job_failed(job_id, str(e))  # e from the last exception
-        return False
+    def mark_job_failed(self, job_id: int, error: str, retry_delay: float | None = None):
+        """
+        Record a failed job in the queue; if the database update fails, keep
+        the job in memory and try again later instead of losing track of it.
+        """
+        try:
+            self.queue.mark_job_failed(job_id, error, retry_delay)
+        except Exception as e:
+            logger.error(
+                f"Error marking job {job_id} as failed, retrying in {DB_ERROR_RETRY_DELAY} seconds: {e}")
+            self.queue.requeue_jobs([job_id], DB_ERROR_RETRY_DELAY)
 
 
 def main():
@@ -241,16 +628,8 @@ def main():
         product_id=args.product_id
     )
 
-    logger.info("Starting printer queue processor...")
-
-    # Start queue processor in a separate thread
-    queue_thread = threading.Thread(
-        target=printer_manager.process_queue, daemon=True)
-    queue_thread.daemon = True  # Set as daemon thread so it exits when main thread exits
-    queue_thread.start()
-
     # Socket.IO setup
-    sio = socketio.Client()
+    sio = socketio.Client(json=fast_json)
 
     logger.info("Starting WebSocket connection...")
 
@@ -271,17 +650,40 @@ def main():
         logger.info("New purchase created!")
         printer_manager.queue.add_to_queue(data)
 
-    # Connect to Socket.IO server
+    def connect_to_server():
+        # retry=True only retries transport errors; a namespace handshake that
+        # times out or is rejected still raises, so keep trying until connected
+        retry_delay = 1
+        while True:
+            try:
+                logger.info(f"Connecting to server at {SOCKET_IO_SERVER_URL}...")
+                # Websocket only, skipping the initial long-polling handshake
+                sio.connect(SOCKET_IO_SERVER_URL, namespaces=[SOCKET_IO_NAMESPACE],
+                            transports=['websocket'], retry=True, wait_timeout=10)
+                return
+            except Exception as e:
+                logger.error(
+                    f"Error connecting to server: {e}. Retrying in {retry_delay} seconds...")
+                try:
+                    sio.disconnect()  # Drop a half-open connection, if any
+                except Exception:
+                    pass
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+
+    # Connect to Socket.IO server; connect blocks until it succeeds, so it gets
+    # a short-lived thread and the client's own threads take over afterwards
+    connect_thread = threading.Thread(target=connect_to_server, daemon=True)
+    connect_thread.start()
+
+    # The main thread would otherwise sit idle in sio.wait(), so it runs the
+    # queue processor itself instead of handing it to another thread
+    logger.info("Starting printer queue processor...")
     try:
-        logger.info(f"Connecting to server at {SOCKET_IO_SERVER_URL}...")
-        sio.connect(SOCKET_IO_SERVER_URL, namespaces=[
-                    SOCKET_IO_NAMESPACE], retry=True)
-        sio.wait()
+        printer_manager.process_queue()
     except KeyboardInterrupt:
         logger.info("Shutting down...")
         sio.disconnect()
-    except Exception as e:
-        logger.error(f"Error: {e}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,16 @@
+"""
+Drop-in replacement for the json module backed by orjson.
+
+python-socketio and python-engineio accept a custom json module and call its
+dumps/loads with stdlib keyword arguments (such as separators), which orjson
+does not take, so they are accepted and ignored here.
+"""
+import orjson
+
+
+def dumps(obj, *args, **kwargs) -> str:
+    return orjson.dumps(obj).decode()
+
+
+def loads(s, *args, **kwargs):
+    return orjson.loads(s)
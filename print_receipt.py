@@ -1,93 +1,143 @@
+import functools
 import logging
-from escpos.printer import Usb
+from escpos.image import EscposImage
 
 logger = logging.getLogger(__name__)
 
+LOGO_PATH = 'logo.png'
+ENCODING = 'cp437'
 
-def format_pos_text(left: str = "", right: str = "", alignment: str = "left"):
-    max_width = 48
+# Raw ESC/POS commands, so a whole receipt can be sent with a single write
+INIT = b'\x1b@'
+SELECT_CODEPAGE = b'\x1bt\x00'  # PC437, matches ENCODING
+ALIGN_LEFT = b'\x1ba\x00'
+ALIGN_CENTER = b'\x1ba\x01'
+TEXT_NORMAL = b'\x1d!\x00'
+RASTER_IMAGE = b'\x1dv0\x00'
+CUT = b'\x1bd\x06\x1dV\x00'  # What printer.cut() sends: feed 6 lines, full cut
 
-    if alignment == "left":
-        return left.ljust(max_width)[:max_width]
 
-    elif alignment == "right":
-        return right.rjust(max_width)[:max_width]
+LINE_WIDTH = 48
 
-    elif alignment == "both":
-        space_available = max_width - len(left) - len(right)
-        if space_available < 1:
-            return (left + " " + right)[:max_width]
-        return left + (" " * space_available) + right
 
-    else:
-        raise ValueError(
-            "Invalid alignment. Choose 'left', 'right', or 'both'.")
+def _pad_both(left: str, right: str) -> str:
+    if len(left) + len(right) < LINE_WIDTH:
+        return f"{left}{right:>{LINE_WIDTH - len(left)}}"
+    return (left + " " + right)[:LINE_WIDTH]
 
 
 def format_price_it(price):
+    # Prices may arrive as numbers or strings, the cache is keyed on the string
+    return _format_price_it(str(price))
+
+
+@functools.lru_cache(maxsize=512)
+def _format_price_it(price: str):
     try:
         # Handle comma as decimal in input strings
-        price_float = float(str(price).replace(",", "."))
+        price_float = float(price.replace(",", "."))
         formatted_price = "{:.2f}".format(price_float).replace(".", ",")
         return f"{formatted_price} EUR"
     except ValueError:
         logger.error(f"Error converting price to float: {price}")
-        return str(price)  # Return original value if not convertible to float
+        return price  # Return original value if not convertible to float
 
 
-def print_receipt(data, printer: Usb):
-    if printer is None:  # Check if printer is valid before using
-        logger.error("Printer not initialized, skipping receipt printing.")
-        return
+def render_logo(path: str = LOGO_PATH) -> bytes:
+    # Same GS v 0 command printer.image() sends with its default settings
+    image = EscposImage(path)
+    return (RASTER_IMAGE
+            + image.width_bytes.to_bytes(2, 'little')
+            + image.height.to_bytes(2, 'little')
+            + image.to_raster_format())
+
+
+def _text(text: str) -> bytes:
+    return text.encode(ENCODING, errors='replace')
+
+
+# Static parts of every receipt, encoded once at import time
+_SEP = b"-" * 32 + b"\n"
+_HEADER = _text("\nVia Piave, 3\n"
+                "41018 - San Cesario sul Panaro (MO)\n"
+                "cafe.kinocampus.it\n"
+                "kinocafesancesario@gmail.com\n") + _SEP
+_COLUMNS = _text(_pad_both("DESCRIZIONE", "EURO"))
+_NOT_FISCAL = _text("*NON FISCALE*\n")
+_GOODBYE = _text("\nGrazie e arrivederci!\n")
+
+
+class EscPosBuffer:
+    """
+    ESC/POS byte buffer that tracks the printer state it has set, so that
+    set() only emits the commands that actually change something.
+    """
+
+    _ALIGN = {'left': ALIGN_LEFT, 'center': ALIGN_CENTER}
+
+    def __init__(self):
+        self.data = bytearray()
+        self.align = None
+        self.normal_textsize = None
+
+    def init(self):
+        # ESC @ restores the defaults: left aligned, normal size text
+        self.data += INIT + SELECT_CODEPAGE
+        self.align = 'left'
+        self.normal_textsize = True
+
+    def set(self, align: str | None = None, normal_textsize: bool = False):
+        if align is not None and align != self.align:
+            self.data += self._ALIGN[align]
+            self.align = align
+        if normal_textsize and not self.normal_textsize:
+            self.data += TEXT_NORMAL
+            self.normal_textsize = True
+
+    def write(self, data: bytes):
+        self.data += data
 
-    try:
-        printer.set(align='center', normal_textsize=True)
-        printer.image('logo.png')
-        printer.text("\nVia Piave, 3\n")
-        printer.text("41018 - San Cesario sul Panaro (MO)\n")
-        printer.text('cafe.kinocampus.it\n')
-        printer.text("kinocafesancesario@gmail.com\n")
-        printer.text(f"{'-' * 32}\n")
 
-        printer.set(align='left')
-        printer.text(format_pos_text("DESCRIZIONE", "EURO", "both"))
+def build_receipt_bytes(data, logo_bytes: bytes) -> bytes:
+    out = EscPosBuffer()
+    out.init()
 
-        printer.set(double_height=False, double_width=False)
+    out.set(align='center', normal_textsize=True)
+    out.write(logo_bytes)
+    out.write(_HEADER)
 
-        for purchased_item in data["purchasedItems"]:
-            item = purchased_item["item"]
-            left_str = item["name"]
-            formatted_price = format_price_it(item["price"])
-            right_str = f"{purchased_item['quantity']}x {formatted_price}"
-            printer.text(format_pos_text(left_str, right_str, "both"))
+    out.set(align='left')
+    out.write(_COLUMNS)
 
-        printer.set(align='center')
-        printer.text(f"{'-' * 32}\n")
+    out.set(normal_textsize=True)
 
-        printer.set(align='left')
-        formatted_total = format_price_it(data['total'])
-        printer.text(format_pos_text(
-            "TOTALE COMPLESSIVO", formatted_total, "both"))
+    for purchased_item in data["purchasedItems"]:
+        item = purchased_item["item"]
+        left_str = item["name"]
+        formatted_price = format_price_it(item["price"])
+        right_str = f"{purchased_item['quantity']}x {formatted_price}"
+        out.write(_text(_pad_both(left_str, right_str)))
 
-        formatted_givenAmount = format_price_it(data['givenAmount'])
-        printer.text(format_pos_text(
-            data['paymentMethod'], formatted_givenAmount, "both"))
+    out.set(align='center')
+    out.write(_SEP)
 
-        if data.get('change'):
-            formatted_change = format_price_it(data['change'])
-            printer.text(format_pos_text("Resto", formatted_change, "both"))
+    out.set(align='left')
+    formatted_total = format_price_it(data['total'])
+    out.write(_text(_pad_both("TOTALE COMPLESSIVO", formatted_total)))
 
-        printer.set(align='center')
-        printer.text(f"\n\n{data['purchaseDate']}\n")
-        printer.text(f"\nID Acquisto: #{str(data['id']).zfill(4)}\n")
+    formatted_givenAmount = format_price_it(data['givenAmount'])
+    out.write(_text(_pad_both(data['paymentMethod'], formatted_givenAmount)))
 
-        printer.text("*NON FISCALE*\n")
+    if data.get('change'):
+        formatted_change = format_price_it(data['change'])
+        out.write(_text(_pad_both("Resto", formatted_change)))
 
-        printer.set(align='center')
-        printer.text("\nGrazie e arrivederci!\n")
+    out.set(align='center')
+    out.write(_text(f"\n\n{data['purchaseDate']}\n"
+                    f"\nID Acquisto: #{str(data['id']).zfill(4)}\n"))
+    out.write(_NOT_FISCAL)
 
-        # remove comment to print receipt
-        printer.cut()
+    out.set(align='center')
+    out.write(_GOODBYE)
 
-    except Exception as e:
-        logger.error(f"Error printing receipt: {e}")
+    return bytes(out.data)
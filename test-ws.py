@@ -3,6 +3,7 @@
 import socketio
 import argparse
 import logging
+import fast_json
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,7 +19,7 @@ def main():
                         default='/purchase', help='Socket.IO namespace (default: /)')
     args = parser.parse_args()
 
-    sio = socketio.Client()
+    sio = socketio.Client(json=fast_json)
 
     @sio.event(namespace=args.namespace)
     def connect():
@@ -39,7 +40,8 @@ def main():
 
     try:
         logger.info(f"Connecting to {args.url}...")
-        sio.connect(args.url, namespaces=[args.namespace], retry=True)
+        sio.connect(args.url, namespaces=[args.namespace],
+                    transports=['websocket'], retry=True)
         sio.wait()
     except KeyboardInterrupt:
         logger.info("Shutting down...")